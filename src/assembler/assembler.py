@@ -9,146 +9,159 @@
 # License (see LICENSE.)
 
 import re
+import struct
 import argparse
 
-# RegEx matching valid character set for the source file. String literals in
-# the source are not subject to this restriction.
-SOURCE_CHARSET = re.compile(r"[\s\\\"a-zA-Z\-0-9:+-_,\[\];#<\.>=\$]")
-
-# These are the valid "control characters" that the preprocessor will recognize.
-VALID_ESCAPE_CHARACTERS = ["\\"]
-VALID_QUOTATION_CHARACTERS = ["\""]
-VALID_EOL_COMMENT_CHARACTERS = [";"]
-VALID_TOKEN_DELIMITER = [" ", ","]
+# RegEx used to split each line of the source into tokens. The alternatives
+# are tried in order, so that (for example) a semicolon inside of a string
+# literal is not mistaken for the start of a comment. Whitespace other than a
+# space (including Unicode whitespace) is not a token delimiter, and is kept as
+# part of the token. String literals in the source are not subject to the
+# restricted character set.
+TOKENIZER = re.compile(r"""
+      "(?P<literal>(?:\\.|[^"\\])*)"            # a double-quoted string
+    | (?P<comment>;.*)                          # an EOL comment
+    | (?P<delimiter>[ ,]+)                      # a token boundary
+    | (?P<token>(?:[a-zA-Z0-9_#$+\-./:<=>?@\[\]^]|[^\S \n])+)
+                                                # (part of) a token
+    | (?P<mismatch>.)                           # anything else is illegal
+""", re.VERBOSE)
+
+# RegEx matching an escape sequence within a string literal; the escaped
+# character is taken literally.
+ESCAPE_SEQUENCE = re.compile(r"\\(.)")
 
 # These are the valid directive statements that the preprocessor will recognize.
-VALID_INCLUDE_DIRECTIVES = ["#include"]
-VALID_PRAGMA_DIRECTIVES = ["#set"]
+VALID_INCLUDE_DIRECTIVES = frozenset(["#include"])
+VALID_PRAGMA_DIRECTIVES = frozenset(["#set"])
 
 class AssemblySyntaxError(Exception):
     pass
 
+def syntax_error(statement, column, line, problem):
+    """Build an AssemblySyntaxError, pointing out the column of the statement
+    at which the problem occurred."""
+    return AssemblySyntaxError(
+        f"\n\n\t{statement}\n\t{' ' * column}^\n{problem} on line {line}."
+    )
+
 class PreprocessorMacroParseError(Exception):
     pass
 
-def preprocess(program):
+def preprocess(program, included=None):
     """Preprocess a SUBLEQ assembly program.
 
     This function accepts a SUBLEQ assembly program as input, and will remove
     empty lines, remove comments, and will expand relevant macros. It will
-    return a list of tokens which can be used by the assembler."""
+    return a list of tokens which can be used by the assembler.
+
+    The preprocessed tokens of each external source file that is included are
+    kept in included (which is shared with any nested #include statements,) so
+    that a file included more than once is only read and preprocessed once."""
+
+    if included is None:
+        included = {}
 
     tokens = []
 
     for line, statement in enumerate(program.split('\n')):
         token = ""
-        quoted = False
-        column = 0
-        while column < len(statement):
-            character = statement[column]
-
-            # Complain if there are any illegal characters in the source.
-            if (not quoted) and (not bool(SOURCE_CHARSET.match(character))):
-                raise AssemblySyntaxError(
-                    f"\n\n\t{statement}\n" +\
-                    f"\t{' '*column}^\n" +\
-                    f"Unexpected character \"{character}\" on line {line}."
-                )
-
-            # If an escape character is encountered...
-            elif (character in VALID_ESCAPE_CHARACTERS):
-                # and it is in a double-quoted string, add the proceeding 
-                # character literal to the current token.
-                if quoted:
-                    token = token + statement[column + 1]
-                    column = column + 1 # also skip that column
-
-                # if it is not quoted, complain.
-                else:
-                    raise AssemblySyntaxError(
-                        f"\n\n\t{statement}\n" +\
-                        f"\t{' '*column}^\n" +\
-                        f"Unexpected escape character on line {line}."
-                    )
-
-            # If a valid (ie. not escaped) quotation mark is encountered, toggle
-            # the current quoted status.
-            elif (character in VALID_QUOTATION_CHARACTERS):
-                quoted = not quoted
+        for match in TOKENIZER.finditer(statement):
+            kind = match.lastgroup
 
-            # If we encounter a semicolon, and we are not currently in a quoted
-            # string literal, the rest of the line is a comment. Ignore it all.
-            elif (not quoted) and (character in VALID_EOL_COMMENT_CHARACTERS):
-                break
+            # Ordinary source characters are appended to the current token.
+            if kind == "token":
+                token += match.group(kind)
 
-            # If we encounter a space, and we are not currently in a quoted
-            # string literal, then we are at a token boundary. Append the
-            # current token to the global list, and clear the current token.
-            elif (not quoted) and (character in VALID_TOKEN_DELIMITER):
+            # If we encounter a space or comma, then we are at a token boundary.
+            # Append the current token to the global list, and clear the
+            # current token.
+            elif kind == "delimiter":
                 if token:
                     tokens.append(token)
                     token = ""
 
-            # Otherwise, the current character can be appended to the current 
-            # token.
-            else:
-                token += character
+            # The contents of a string literal (less the quotation marks) are
+            # also appended to the current token, after resolving escapes (if
+            # there are any.)
+            elif kind == "literal":
+                literal = match.group(kind)
+                if ("\\" in literal):
+                    literal = ESCAPE_SEQUENCE.sub(r"\1", literal)
+                token += literal
+
+            # If we encounter a semicolon, the rest of the line is a comment.
+            # Ignore it all.
+            elif kind == "comment":
+                break
 
-            # Then, continue parsing the next character.
-            column = column + 1
+            # Otherwise, complain. An unmatched quotation mark means that the
+            # string literal runs off the end of the line.
+            else:
+                column = match.start()
+                character = match.group(kind)
+
+                if character == "\"":
+                    raise syntax_error(statement, len(statement), line,
+                        "Unexpected EOL")
+                elif character == "\\":
+                    raise syntax_error(statement, column, line,
+                        "Unexpected escape character")
+                else:
+                    raise syntax_error(statement, column, line,
+                        f"Unexpected character \"{character}\"")
 
         # The very last token in every line will not get added to the global
         # list, so it is manually appended here.
         if token:
             tokens.append(token)
 
-        # If, at the end of the line, we are for some reason in a quoted string,
-        # complain.
-        if quoted:
-            raise AssemblySyntaxError(
-                f"\n\n\t{statement}\n" +\
-                f"\t{' '*column}^\n" +\
-                f"Unexpected EOL on line {line}."
-            )
-
     # Now, we can parse the #include statements (which include an external
-    # source file.)
+    # source file) and the #set statements. Rather than splicing the result of
+    # each directive into the tokens list, the tokens are copied forward into a
+    # new list.
     directives = {}
+    processed = []
 
     index = 0
-    while (index < len(tokens)):
+    count = len(tokens) # the tokens list is not modified by this loop
+    while (index < count):
         token = tokens[index]
 
         if (token in VALID_INCLUDE_DIRECTIVES):
             # Extract the name of the external file to include.
             include = tokens[index + 1][1:-1]
+            index = index + 1   # skip the name of the file
+
+            # Preprocess the external source file (unless it has already been
+            # included,) and insert the processed tokens into the "master"
+            # tokens list.
+            if (include not in included):
+                try:
+                    with open(include) as fh:
+                        external = fh.read()
+                except FileNotFoundError:
+                    raise PreprocessorMacroParseError(
+                        f"\n\nCould not include external source file <{include}>."
+                    )
 
-            try:
-                with open(include) as fh:
-                    external = fh.read()
-
-                # Preprocess the external source file, and insert the processed
-                # tokens into the "master" tokens list.
-                _, external_tokens = preprocess(external)
-                tokens[index:index+2] = external_tokens
-            except FileNotFoundError:
-                raise PreprocessorMacroParseError(
-                    f"\n\nCould not include external source file <{include}>."
-                )
+                _, included[include] = preprocess(external, included)
+
+            processed.extend(included[include])
 
         elif (token in VALID_PRAGMA_DIRECTIVES):
             # Extract the pragmatic statement.
             key, value = tokens[index + 1].split('=')
             directives[key] = value
 
-            tokens.pop(index)   # remove the directive from the tokens list
-            tokens.pop(index)   # remove the statement from the tokens list
-            index = index - 1   # decrement the index (otherwise statements may
-                                # be skipped.)
+            index = index + 1   # skip the statement
+
+        else:
+            processed.append(token)
 
         index = index + 1
 
-    return (directives, tokens)
+    return (directives, processed)
 
 # This dictionary lists the valid assembly operations supported by this
 # assembler. Each key references a tuple, containing (a) the number of
@@ -171,6 +184,105 @@ OPERATIONS = {
     'halt': (0, 3)
 }
 
+# The following functions synthesize the "pure SUBLEQ" form of each assembly
+# operation. Each accepts the (resolved) parameters of the operation, the
+# address that it will be written to, and the addresses of the
+# assembler-accessible memory locations. They return the memory cells of the
+# assembled operation, three cells (one SUBLEQ instruction) per row.
+
+def emit_noop(parameters, ip, X, Y):
+    return [X, X, ip + 3]
+
+def emit_subleq(parameters, ip, X, Y):
+    o1, o2, o3 = parameters
+    return [o1, o2, o3]
+
+def emit_add(parameters, ip, X, Y):
+    o1, o2 = parameters
+    return [o1, X, ip + 3,
+            X, o2, ip + 6,
+            X, X, ip + 9]
+
+def emit_sub(parameters, ip, X, Y):
+    o1, o2 = parameters
+    return [o1, o2, ip + 3]
+
+def emit_zer(parameters, ip, X, Y):
+    addr, = parameters
+    return [addr, addr, ip + 3]
+
+def emit_mov(parameters, ip, X, Y):
+    src, dest = parameters
+    return [dest, dest, ip + 3,
+            src, X, ip + 6,
+            X, dest, ip + 9,
+            X, X, ip + 12]
+
+def emit_jmp(parameters, ip, X, Y):
+    addr, = parameters
+    return [X, X, addr]
+
+def emit_beq(parameters, ip, X, Y):
+    o, addr = parameters
+    return [o, X, ip + 6,
+            X, X, ip + 12,
+            X, X, ip + 9,
+            X, o, addr]
+
+def emit_cmp(parameters, ip, X, Y):
+    o1, o2, addr = parameters
+    return [Y, Y, ip + 3,       # mov <A> Y
+            o1, X, ip + 6,
+            X, Y, ip + 9,
+            X, X, ip + 12,
+            o2, Y, ip + 15,     # sub <B> Y
+            Y, X, ip + 21,      # beq Y <C>
+            X, X, ip + 27,
+            X, X, ip + 24,
+            X, Y, addr]
+
+def emit_in(parameters, ip, X, Y):
+    addr, = parameters
+    return [-1, addr, ip + 3]
+
+def emit_out(parameters, ip, X, Y):
+    addr, = parameters
+    return [addr, -1, ip + 3]
+
+def emit_int(parameters, ip, X, Y):
+    n, = parameters
+    return [n]
+
+def emit_bytes(parameters, ip, X, Y):
+    s, = parameters
+    return s
+
+def emit_halt(parameters, ip, X, Y):
+    return [-1, -1, 0]
+
+# This dictionary maps each assembly operation to the function which emits its
+# assembled form.
+EMITTERS = {
+    'noop': emit_noop,
+    'subleq': emit_subleq,
+    'add': emit_add,
+    'sub': emit_sub,
+    'zer': emit_zer,
+    'mov': emit_mov,
+    'jmp': emit_jmp,
+    'beq': emit_beq,
+    'cmp': emit_cmp,
+    'in': emit_in,
+    'out': emit_out,
+    'int': emit_int,
+    'bytes': emit_bytes,
+    'halt': emit_halt
+}
+
+# These are the struct format characters for each of the supported sizes (in
+# bytes) of the integers written to the program binary.
+INTEGER_FORMATS = {1: "b", 2: "h", 4: "i", 8: "q"}
+
 class AssemblerError(Exception):
     pass
 
@@ -209,13 +321,10 @@ def assemble(tokens, directives={}):
             Halt.
     """
 
-    memory = []
-
     # First, we insert a "preamble" - SUBLEQ bytecode and memory locations that
     # are referenced by the assembler itself.
 
     preamble = [3, 3, 6, 0, 0, 0]
-    memory.extend(preamble)
 
     X, Y = 3, 4       # addresses of assembler-accessible memory locations
 
@@ -235,12 +344,13 @@ def assemble(tokens, directives={}):
 
 
     index = 0
-    while (index < len(tokens)):
+    count = len(tokens) # the tokens list is not modified by this loop
+    while (index < count):
         token = tokens[index]
 
         # If the token is a supported operation, extract it and its parameters
         # and append that information to the sequence list.
-        if (token in OPERATIONS.keys()):
+        if (token in OPERATIONS):
             arguments, size = OPERATIONS[token]
             
             # Increment the assembler-tracked instruction pointer by the "size"
@@ -256,8 +366,17 @@ def assemble(tokens, directives={}):
             for _ in range(arguments):
                 parameter = tokens[index + 1]
 
-                if (parameter.startswith('[') and parameter.endswith(']')):
-                    if (parameter not in constants.keys()):
+                # Inline constants are parsed when they are first encountered.
+                # Constants that refer to a label are resolved once all of the
+                # labels are known.
+                if (parameter not in constants) and \
+                        (parameter.startswith('[') and parameter.endswith(']')):
+                    literal = parameter[1:-1]
+                    if literal.isdigit():
+                        constants[parameter] = int(literal)
+                    elif literal.startswith("0x"):
+                        constants[parameter] = int(literal, 16)
+                    else:
                         constants[parameter] = None
 
                 parameters.append(parameter)
@@ -268,7 +387,7 @@ def assemble(tokens, directives={}):
         # If the token is a label, extract it and store its address.
         elif (token.endswith(":")):
             label = token[:-1]
-            if (label in labels.keys()):
+            if (label in labels):
                 raise AssemblerError(
                     f"\n\nLabel \"{label}\" declared multiple times."
                 )
@@ -281,21 +400,26 @@ def assemble(tokens, directives={}):
         index = index + 1
 
     # Now, we can allocate memory locations for the constants.
-    for constant in constants.keys():
-        if (constant[1:-1]).isdigit():
-            constants[constant] = (int(constant[1:-1]), ip)
-        elif (constant[1:-1]).startswith("0x"):
-            constants[constant] = (int(constant[1:-1], 16), ip)
-        elif (constant[1:-1] in labels.keys()):
-            constants[constant] = (labels[constant[1:-1]], ip)
-        else:
-            raise AssemblerError(f"\n\nUnrecognized constant {constant}.")
+    for constant, value in constants.items():
+        if (value is None):
+            if (constant[1:-1] not in labels):
+                raise AssemblerError(f"\n\nUnrecognized constant {constant}.")
+            value = labels[constant[1:-1]]
+
+        constants[constant] = (value, ip)
 
         ip = ip + 1
 
+    # The size of the assembled program is now known, so its memory can be
+    # allocated all at once (beginning with the preamble.)
+    memory = [0] * ip
+    memory[:len(preamble)] = preamble
+
     # Now, we can replace each assembly instruction with its synthesized "pure
     # SUBLEQ" form.
     ip = len(preamble)
+    resolved = {}       # keep a dictionary of the parameters resolved so far,
+                        # so that repeated parameters are only parsed once.
 
     for instruction, parameters in sequence:
         # First, we parse the parameters to ensure they are all direct
@@ -306,104 +430,35 @@ def assemble(tokens, directives={}):
         #  - <literal address>
         #  - [<constant>]
         for position, parameter in enumerate(parameters):
-            if (parameter in labels.keys()):
-                parameters[position] = labels[parameter]
-            elif (parameter.startswith('[') and parameter.endswith(']')):
+            if (parameter in resolved):
+                parameters[position] = resolved[parameter]
+                continue
+
+            if (parameter in labels):
+                address = labels[parameter]
+            elif (parameter in constants):
                 _, address = constants[parameter]
-                parameters[position] = address
             elif (parameter.isdigit()):
-                parameters[position] = int(parameter)
+                address = int(parameter)
             elif ('+' in parameter):
                 label, offset = parameter.split('+')
-                parameters[position] = labels[label] + int(offset)
+                address = labels[label] + int(offset)
             else:
-                parameters[position] = [ord(c) for c in parameter]
+                address = [ord(c) for c in parameter]
 
-        # Now, we can write the instructions to memory.
+            resolved[parameter] = parameters[position] = address
 
-        if instruction == 'noop':
-            ip = ip + 3; memory.extend([X, X, ip])
-
-        elif instruction == 'subleq':
-            o1, o2, o3 = parameters
-            ip = ip + 3; memory.extend([o1, o2, o3])
-
-        elif instruction == 'add':
-            o1, o2 = parameters
-            ip = ip + 3; memory.extend([o1, X, ip])
-            ip = ip + 3; memory.extend([X, o2, ip])
-            ip = ip + 3; memory.extend([X, X, ip]) 
-
-        elif instruction == 'sub':
-            o1, o2 = parameters
-            ip = ip + 3; memory.extend([o1, o2, ip])
-
-        elif instruction == 'zer':
-            addr, = parameters
-            ip = ip + 3; memory.extend([addr, addr, ip])
-
-        elif instruction == 'mov':
-            src, dest = parameters
-            ip = ip + 3; memory.extend([dest, dest, ip])
-            ip = ip + 3; memory.extend([src, X, ip])
-            ip = ip + 3; memory.extend([X, dest, ip])
-            ip = ip + 3; memory.extend([X, X, ip])
-
-        elif instruction == 'jmp':
-            addr, = parameters
-            ip = ip + 3; memory.extend([X, X, addr])
-
-        elif instruction == 'beq':
-            o, addr = parameters
-            ip = ip + 3; memory.extend([o, X, ip + 3])
-            ip = ip + 3; memory.extend([X, X, ip + 6])
-            ip = ip + 3; memory.extend([X, X, ip])
-            ip = ip + 3; memory.extend([X, o, addr])
-
-        elif instruction == 'cmp':
-            o1, o2, addr = parameters
-            # mov <A> Y
-            ip = ip + 3; memory.extend([Y, Y, ip])
-            ip = ip + 3; memory.extend([o1, X, ip])
-            ip = ip + 3; memory.extend([X, Y, ip])
-            ip = ip + 3; memory.extend([X, X, ip])
-            # sub <B> Y
-            ip = ip + 3; memory.extend([o2, Y, ip])
-            # beq Y <C>
-            ip = ip + 3; memory.extend([Y, X, ip + 3])
-            ip = ip + 3; memory.extend([X, X, ip + 6])
-            ip = ip + 3; memory.extend([X, X, ip])
-            ip = ip + 3; memory.extend([X, Y, addr])
-        
-        elif instruction == 'in':
-            addr, = parameters
-            ip = ip + 3; memory.extend([-1, addr, ip])
-
-        elif instruction == 'out':      
-            addr, = parameters
-            ip = ip + 3; memory.extend([addr, -1, ip])
-
-        elif instruction == 'int':
-            n, = parameters
-            ip = ip + 1; memory.extend([n])
-
-        elif instruction == 'bytes':
-            s, = parameters
-            ip = ip + len(s); memory.extend(s)
-
-        elif instruction == 'halt':
-            ip = ip + 3; memory.extend([-1, -1, 0])
+        # Now, we can write the instructions to memory.
+        cells = EMITTERS[instruction](parameters, ip, X, Y)
+        memory[ip:ip + len(cells)] = cells; ip = ip + len(cells)
 
     # We can also write all constants to program memory. This includes the
     # program entry point (if it has been configured using the #set ENTRY=XYZ)
     # directive. 
-    if ("ENTRY" in directives.keys()):
+    if ("ENTRY" in directives):
         memory[2] = labels[directives["ENTRY"]]
 
     for constant, (value, address) in constants.items():
-        while (len(memory) <= address):
-            memory.append(0)
-
         memory[address] = value
 
     return memory
@@ -415,6 +470,7 @@ if __name__ == "__main__":
     parser.add_argument("-o", "--out", help="assembled output file",
         default="a.out")
     parser.add_argument("-s", "--size", type=int, default=4,
+        choices=sorted(INTEGER_FORMATS),
         help="size (in bytes) of integers to write to program binary")
 
     args = parser.parse_args()
@@ -425,6 +481,9 @@ if __name__ == "__main__":
     directives, tokens = preprocess(program)
     memory = assemble(tokens, directives=directives)
 
+    # Pack the whole program into big-endian integers at once, rather than
+    # converting one memory cell at a time.
     with open(args.out, "wb") as fh:
-        for v in memory:
-            fh.write(v.to_bytes(args.size, byteorder="big", signed=True))
\ No newline at end of file
+        fh.write(struct.pack(
+            f">{len(memory)}{INTEGER_FORMATS[args.size]}", *memory
+        ))
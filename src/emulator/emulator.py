@@ -9,48 +9,159 @@
 # License (see LICENSE.)
 
 import sys
+import collections
+import struct
 import argparse
 
+# These are the struct format characters for each of the supported sizes (in
+# bytes) of the integers read from the program binary.
+INTEGER_FORMATS = {1: "b", 2: "h", 4: "i", 8: "q"}
+
+# The number of values that the machine may output before they are written to
+# standard output.
+OUTPUT_BUFFER_SIZE = 4096
+
+def load(program, size):
+    """ Decode a program binary, in which each memory cell is stored as a
+    big-endian signed integer of the given size (in bytes.) """
+    cells, remainder = divmod(len(program), size)
+
+    # All of the whole cells are unpacked at once.
+    memory = list(struct.unpack_from(
+        f">{cells}{INTEGER_FORMATS[size]}", program
+    ))
+
+    # If the binary is truncated, the final cell is decoded from whatever bytes
+    # remain.
+    if remainder:
+        memory.append(
+            int.from_bytes(program[-remainder:], byteorder="big", signed=True)
+        )
+
+    return memory
+
+def execute(memory, ip):
+    """ Execute SUBLEQ instructions in memory, starting at address ip, until an
+    instruction that performs I/O (or halts the machine) is fetched. Returns the
+    address of the next instruction, and the three operands of the fetched
+    one.
+
+    If an instruction faults, the address of that instruction is attached to
+    the exception raised (as its ip attribute.) """
+    if ip < 0:
+        raise ValueError(f"Cannot execute at negative address {ip}.")
+
+    try:
+        while True:
+            a = memory[ip]
+            b = memory[ip + 1]
+            c = memory[ip + 2]
+
+            if (a == -1) or (b == -1):
+                return ip + 3, a, b, c
+
+            value = memory[b] - memory[a]
+            memory[b] = value
+            if value <= 0:
+                # Negative indices would otherwise wrap around to the end of
+                # memory.
+                if c < 0:
+                    raise ValueError(f"Cannot jump to negative address {c}.")
+                ip = c
+            else:
+                ip += 3
+    except BaseException as error:
+        error.ip = ip
+        raise
+
 class VirtualMachine:
     """ A virtual machine of the SUBLEQ one-instruction set computer. """
     def run(self):
+        """ Run the machine until it halts, and return its exit status. """
+        # The debugger needs to stop before every instruction, so it is given a
+        # separate loop; this keeps the debugger checks out of the usual one.
+        if (self.args.debugger):
+            return self.run_debugger()
+        else:
+            return self.run_uninterrupted()
+
+    def run_uninterrupted(self):
+        """ Run the machine without the debugger. """
+        # Bind the machine state to locals for the duration of the run, rather
+        # than looking it up on every cycle.
+        memory = self.memory
+        inputs = self.inputs
+        ip = self.ip
+
+        # Machine output is collected here, and written to standard output in
+        # batches rather than with one print() per value. The batch is also
+        # written whenever the machine pauses to prompt for input, and when
+        # it stops running. In ASCII mode, it is also written at each newline.
+        output = []
+
+        if (self.args.ascii):
+            render, newline = chr, 10
+        else:
+            render, newline = "{}\n".format, None
+
+        def flush():
+            sys.stdout.write("".join(output))
+            output.clear()
+
+        try:
+            while True:
+                # The machine can run uninterrupted until it reaches an
+                # instruction that performs I/O.
+                ip, a, b, c = execute(memory, ip)
+
+                if (a == -1) and (b == -1):
+                    return c
+                elif (a == -1):
+                    if not inputs:
+                        flush()
+
+                    memory[b] = self.read()
+                else:
+                    value = memory[a]
+                    output.append(render(value))
+                    if (value == newline) or (len(output) >= OUTPUT_BUFFER_SIZE):
+                        flush()
+        except BaseException as error:
+            # If an instruction faulted, leave the machine pointing at it.
+            ip = getattr(error, "ip", ip)
+            raise
+        finally:
+            flush()
+            self.ip = ip
+
+    def run_debugger(self):
+        """ Run the machine under the debugger, which prompts for a command
+        before each instruction is executed. """
         while True:
             a, b, c = self.memory[self.ip : self.ip + 3]
             self.ip += 3
 
-            if (self.args.debugger):
-                # print the current instruction pointer and command to execute
-                print(f"\n[{hex(self.ip-3)[2:].zfill(4)}] {a} {b} {c} ")
+            # print the current instruction pointer and command to execute
+            print(f"\n[{hex(self.ip-3)[2:].zfill(4)}] {a} {b} {c} ")
 
-                instruction = input("> ")
-                tokens = instruction.split(" ")
-                if (tokens[0].lower() in ["e", "execute"]):
-                    pass
-                elif (tokens[0].lower() in ["s", "skip"]):
-                    continue
-                elif (tokens[0].lower() in ["m", "modify"]):
-                    a, b, c = [int(v) for v in tokens[1].split(",")]
+            instruction = input("> ")
+            tokens = instruction.split(" ")
+            if (tokens[0].lower() in ["e", "execute"]):
+                pass
+            elif (tokens[0].lower() in ["s", "skip"]):
+                continue
+            elif (tokens[0].lower() in ["m", "modify"]):
+                a, b, c = [int(v) for v in tokens[1].split(",")]
 
             if (a == -1) and (b == -1):
-                if (self.args.debugger):
-                    print(f"Terminated with status {c}.")
+                print(f"Terminated with status {c}.")
                 return c
             elif (a == -1):
-                # If the input queue is empty, then prompt the user for input
-                # via stdin.
                 if not self.inputs:
-                    if (self.args.debugger):
-                        print("\n\n[!] The input queue is empty; prompting " +\
-                              "for additional input.")
-
-                    self.inputs.extend( [ord(c) for c in input("\n> ") ] )
-
-                    # Optionally null-terminate all input that is passed to the
-                    # machine.
-                    if self.args.null_terminate_input:
-                        self.inputs.extend( [0] )
+                    print("\n\n[!] The input queue is empty; prompting " +\
+                          "for additional input.")
 
-                self.memory[b] = self.inputs.pop(0)
+                self.memory[b] = self.read()
             elif (b == -1):
                 if self.args.ascii:
                     print(chr(self.memory[a]), end='')
@@ -59,12 +170,32 @@ class VirtualMachine:
             else:
                 self.memory[b] -= self.memory[a]
                 if self.memory[b] <= 0:
+                    if c < 0:
+                        raise ValueError(
+                            f"Cannot jump to negative address {c}."
+                        )
                     self.ip = c
 
+    def read(self):
+        """ Take the next value from the input queue. If the input queue is
+        empty, then prompt the user for input via stdin. """
+        if not self.inputs:
+            self.feed(input("\n> "))
+
+        return self.inputs.popleft()
+
+    def feed(self, line):
+        """ Append the characters of a line of input to the input queue. """
+        self.inputs.extend( [ord(c) for c in line] )
+
+        # Optionally null-terminate all input that is passed to the machine.
+        if self.args.null_terminate_input:
+            self.inputs.extend( [0] )
+
     def __init__(self, memory=[], args=None):
         self.memory = memory
         self.ip = 0
-        self.inputs = []
+        self.inputs = collections.deque()
         self.args = args
 
 if __name__ == '__main__':
@@ -85,14 +216,21 @@ if __name__ == '__main__':
         action="store_true"
     )
     parser.add_argument("-s", "--size", type=int, default=4,
+        choices=sorted(INTEGER_FORMATS),
         help="size (in bytes) of integers to read from program binary")
 
     args = parser.parse_args()
 
     with open(args.program, "rb") as fh:
-        memory = []
-        while (v := fh.read(args.size)):
-            memory.append(int.from_bytes(v, byteorder="big", signed=True))
+        memory = load(fh.read(), args.size)
 
     vm = VirtualMachine(memory=memory, args=args)
+
+    # If input is being piped in (rather than typed at a terminal,) then queue
+    # it all up front instead of prompting for it whenever the queue runs dry.
+    # The debugger reads its commands from standard input, so it is left to
+    # prompt as usual.
+    if not (sys.stdin.isatty() or args.debugger):
+        for line in sys.stdin:
+            vm.feed(line.rstrip("\n"))
     vm.run()